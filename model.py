@@ -95,7 +95,8 @@ class MultiHeadAttention(nn.Module):
         v = rearrange(v, pattern="b n (h d) -> b h n d", h=self.n_heads, d=self.head_size)
         attn_score = self._get_attention_score(q=q, k=k)
         if mask is not None:
-            attn_score.masked_fill_(mask=mask, value=-1e9)
+            # The lowest finite value of the dtype, since -1e9 overflows "float16" under autocast.
+            attn_score.masked_fill_(mask=mask, value=torch.finfo(attn_score.dtype).min)
         attn_weight = F.softmax(attn_score, dim=3)
         x = torch.einsum("bhnm,bhmd->bhnd", attn_weight, v)
         x = rearrange(x, pattern="b h n d -> b n (h d)")
@@ -202,8 +203,6 @@ class BERT(nn.Module):
             drop_prob=drop_prob,
         )
 
-        self.ce = nn.CrossEntropyLoss()
-
     def _get_pad_mask(self, token_ids):
         mask = (token_ids == self.pad_id).unsqueeze(1).unsqueeze(2)
         mask.requires_grad = False
@@ -215,25 +214,6 @@ class BERT(nn.Module):
         x = self.tf_block(x, mask=pad_mask)
         return x
 
-    # "The training loss is the sum of the mean masked LM likelihood and the mean
-    # next sentence prediction likelihood."
-    def get_pretraining_loss(self, pred_is_next, gt_is_next, pred_token_ids, gt_token_ids, select_mask):
-        nsp_loss = self.ce(pred_is_next, gt_is_next)
-
-        gt_token_ids[~select_mask] = -100
-        mlm_loss = self.ce(pred_token_ids.view(-1, self.vocab_size), gt_token_ids.view(-1))
-        return nsp_loss, mlm_loss
-
-    def get_nsp_acc(pred_is_next, gt_is_next):
-        argmax = torch.argmax(pred_is_next, dim=1)
-        acc = (gt_is_next == argmax).float().mean()
-        return acc.item()
-
-    def get_mlm_acc(pred_token_ids, gt_token_ids):
-        argmax = torch.argmax(pred_token_ids, dim=2)
-        acc = (gt_token_ids == argmax).sum() / gt_token_ids.numel()
-        return acc.item()
-
 
 class MLMHead(nn.Module):
     def __init__(self, vocab_size, hidden_size=768):
@@ -275,12 +255,37 @@ class BERTForPretraining(nn.Module):
         self.nsp_head = NSPHead(hidden_size)
         self.mlm_head = MLMHead(vocab_size=vocab_size, hidden_size=hidden_size)
 
+        self.ce = nn.CrossEntropyLoss()
+
     def forward(self, token_ids, seg_ids):
         x = self.bert(token_ids=token_ids, seg_ids=seg_ids)
         pred_is_next = self.nsp_head(x)
         pred_token_ids = self.mlm_head(x)
         return pred_is_next, pred_token_ids
 
+    # "The training loss is the sum of the mean masked LM likelihood and the mean
+    # next sentence prediction likelihood."
+    def get_pretraining_loss(self, pred_is_next, gt_is_next, pred_token_ids, gt_token_ids, select_mask):
+        nsp_loss = self.ce(pred_is_next, gt_is_next)
+
+        # Not in-place so that `gt_token_ids` can still be used afterwards.
+        gt_token_ids = gt_token_ids.masked_fill(~select_mask, -100)
+        mlm_loss = self.ce(pred_token_ids.view(-1, self.bert.vocab_size), gt_token_ids.view(-1))
+        return nsp_loss, mlm_loss
+
+    # The accuracies are returned as tensors so that they can be accumulated on the device.
+    def get_nsp_acc(self, pred_is_next, gt_is_next):
+        argmax = torch.argmax(pred_is_next, dim=1)
+        acc = (gt_is_next == argmax).float().mean()
+        return acc
+
+    def get_mlm_n_corrects(self, pred_token_ids, gt_token_ids, select_mask):
+        # Only over the tokens chosen for prediction. Returns the counts rather than their
+        # ratio so that batches selecting no tokens need no special handling.
+        argmax = torch.argmax(pred_token_ids, dim=2)
+        n_corrects = ((gt_token_ids == argmax) & select_mask).sum()
+        return n_corrects, select_mask.sum()
+
 
 class QuestionAnsweringHead(nn.Module):
     def __init__(self, hidden_size):
@@ -3,17 +3,28 @@
     # https://d2l.ai/chapter_natural-language-processing-pretraining/bert-dataset.html
 
 import os
+import hashlib
 import torch
-from torch.utils.data import Dataset
+import numpy as np
+from numba import njit
+from pathlib import Path
+from torch.utils.data import Dataset, Sampler
 import random
+from tqdm.auto import tqdm
 
 import config
-from pretrain.wordpiece import load_fast_bert_tokenizer
-from utils import _token_ids_to_segment_ids
+from pretrain.wordpiece import load_fast_bert_tokenizer, get_special_ids
 from pretrain.wordpiece import parse
 
 os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
+# Token IDs of the tokenized corpus are stored in 2 bytes each; `VOCAB_SIZE` must not exceed
+# 65,536.
+TOKEN_ID_DTYPE = np.uint16
+# When bucketing, batches are padded to a multiple of this so that only a few distinct
+# shapes (and CUDA graphs, with `torch.compile(mode="max-autotune")`) exist.
+BATCH_LEN_MULTIPLE = 16
+
 
 def _encode(x, tokenizer):
     encoding = tokenizer(
@@ -29,6 +40,76 @@ def _encode(x, tokenizer):
         return [token_ids[1: -1] for token_ids in encoding["input_ids"]]
 
 
+def _encode_in_batches(lines, tokenizer, max_len, chunk_size=10_000):
+    # Calls the Rust backend's `encode_batch()` directly so that each chunk is tokenized
+    # in parallel; truncation happens on the Rust side as well.
+    backend_tokenizer = tokenizer.backend_tokenizer
+    backend_tokenizer.enable_truncation(max_length=max_len)
+    ls_token_ids = list()
+    for i in tqdm(range(0, len(lines), chunk_size)):
+        encodings = backend_tokenizer.encode_batch(
+            lines[i: i + chunk_size], add_special_tokens=False,
+        )
+        ls_token_ids.extend(
+            [np.array(encoding.ids, dtype=TOKEN_ID_DTYPE) for encoding in encodings]
+        )
+    backend_tokenizer.no_truncation()
+    return ls_token_ids
+
+
+# The tokenized corpus is stored in CSR layout: every paragraph's token IDs are concatenated
+# into `corpus.bin` and the `idx`-th paragraph is `corpus[offsets[idx]: offsets[idx + 1]]`.
+def _save_tokenized_corpus(ls_token_ids, tokenized_dir):
+    Path(tokenized_dir).mkdir(parents=True, exist_ok=True)
+    lens = [len(token_ids) for token_ids in ls_token_ids]
+    offsets = np.cumsum([0] + lens).astype(np.int64)
+    flat = np.concatenate(ls_token_ids).astype(TOKEN_ID_DTYPE, copy=False)
+    # Each file is written under a temporary name and then renamed, the offsets last, so that
+    # `offsets.bin` only exists once both files are complete.
+    for arr, name in [(flat, "corpus.bin"), (offsets, "offsets.bin")]:
+        tmp_path = Path(tokenized_dir)/f"{name}.tmp"
+        arr.tofile(tmp_path)
+        os.replace(tmp_path, Path(tokenized_dir)/name)
+
+
+def _get_tokenizer_hash(tokenizer):
+    # Identifies the vocabulary and the normalization/pre-tokenization rules, so that a corpus
+    # tokenized with another tokenizer is never reused.
+    return hashlib.sha1(tokenizer.backend_tokenizer.to_str().encode("utf-8")).hexdigest()[: 8]
+
+
+def _load_tokenized_corpus(tokenized_dir):
+    flat = np.memmap(Path(tokenized_dir)/"corpus.bin", dtype=TOKEN_ID_DTYPE, mode="r")
+    offsets = np.memmap(Path(tokenized_dir)/"offsets.bin", dtype=np.int64, mode="r")
+    if len(flat) != offsets[-1]:
+        raise ValueError(
+            f"The tokenized corpus in '{tokenized_dir}' is incomplete or stale;"
+            " please delete it and tokenize again."
+        )
+    return flat, offsets
+
+
+# Compiled to native code because it runs once per sample. Both token ID arguments are NumPy
+# arrays (a new specialization is compiled for each of their dtypes).
+@njit(cache=True)
+def build_bert_sample(former_token_ids, latter_token_ids, seq_len, cls_id, sep_id, pad_id):
+    token_ids = np.full(seq_len, pad_id, dtype=np.int32) # Pad.
+    seg_ids = np.zeros(seq_len, dtype=np.int8)
+    former_len = min(len(former_token_ids), seq_len - 2)
+    # Add "[CLS]" and the first "[SEP]" tokens.
+    token_ids[0] = cls_id
+    token_ids[1: 1 + former_len] = former_token_ids[: former_len]
+    token_ids[1 + former_len] = sep_id
+    latter_start = 2 + former_len
+    if latter_start < seq_len - 1:
+        latter_len = min(len(latter_token_ids), seq_len - 1 - latter_start)
+        token_ids[latter_start: latter_start + latter_len] = latter_token_ids[: latter_len]
+        token_ids[latter_start + latter_len] = sep_id # Add the second "[SEP]" token.
+        # The positions from right after the first '[SEP]' token and to the second '[SEP]' token
+        seg_ids[latter_start: latter_start + latter_len + 1] = 1
+    return token_ids, seg_ids
+
+
 # "For the pre-training corpus we use the BookCorpus (800M words) (Zhu et al., 2015)
 # and English Wikipedia (2,500M words)."
 # "For Wikipedia we extract only the text passages and ignore lists, tables, and headers.
@@ -40,53 +121,166 @@ class BookCorpusForBERT(Dataset):
         epubtxt_dir,
         tokenizer,
         seq_len,
+        tokenize_in_advance=False,
+        tokenized_dir=None,
+        bucket_by_len=False,
     ):
         self.epubtxt_dir = epubtxt_dir
         self.tokenizer = tokenizer
         self.seq_len = seq_len
+        self.tokenize_in_advance = tokenize_in_advance
+        self.bucket_by_len = bucket_by_len
+        if tokenized_dir is None:
+            tokenized_dir = Path(epubtxt_dir).parent/(
+                f"epubtxt_tokenized_seq_len_{seq_len}_tokenizer_{_get_tokenizer_hash(tokenizer)}"
+            )
+        self.tokenized_dir = Path(tokenized_dir)
+
+        special_ids = get_special_ids(tokenizer)
+        self.unk_id = special_ids.unk
+        self.cls_id = special_ids.cls
+        self.sep_id = special_ids.sep
+        self.pad_id = special_ids.pad
+        self.mask_id = special_ids.mask
+
+        if tokenize_in_advance:
+            assert len(tokenizer) <= np.iinfo(TOKEN_ID_DTYPE).max + 1
+            if not (self.tokenized_dir/"offsets.bin").exists():
+                lines = parse(epubtxt_dir)
+                print("Tokenizing BookCorpus...")
+                # Only the first `seq_len - 2` tokens of a paragraph can ever be used.
+                ls_token_ids = _encode_in_batches(
+                    lines, tokenizer=tokenizer, max_len=seq_len - 2,
+                )
+                _save_tokenized_corpus(ls_token_ids, tokenized_dir=self.tokenized_dir)
+                print("Completed.")
+            # Memory-mapped arrays are shared between the DataLoader workers instead of
+            # being copied into each of them.
+            self.flat, self.offsets = _load_tokenized_corpus(self.tokenized_dir)
+            self.n_paragraphs = len(self.offsets) - 1
+        else:
+            self.lines = parse(epubtxt_dir)
+            self.n_paragraphs = len(self.lines)
 
-        self.unk_id = tokenizer.unk_token_id
-        self.cls_id = tokenizer.cls_token_id
-        self.sep_id = tokenizer.sep_token_id
-        self.pad_id = tokenizer.pad_token_id
+    # Pickling a `np.memmap` copies its whole content, so when the DataLoader workers are not
+    # forked (e.g., "forkserver" on macOS) they re-open the files instead.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("flat", None)
+        state.pop("offsets", None)
+        return state
 
-        self.lines = parse(epubtxt_dir)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.tokenize_in_advance:
+            self.flat, self.offsets = _load_tokenized_corpus(self.tokenized_dir)
 
-    def _sample_latter_sentence(self, idx):
+    def _get_token_ids(self, idx):
+        if self.tokenize_in_advance:
+            return self.flat[self.offsets[idx]: self.offsets[idx + 1]]
+        return np.array(_encode(self.lines[idx], tokenizer=self.tokenizer), dtype=np.int32)
+
+    def _sample_latter_sentence(self, idx, former_len):
         if random.random() < 0.5:
             latter_idx = idx + 1
             is_next = 1
         else:
-            latter_idx = random.randrange(len(self.lines))
+            # Draw uniformly from every paragraph except the actual next one so that
+            # `is_next = 0` is never mislabeled.
+            latter_idx = random.randrange(self.n_paragraphs - 1)
+            if latter_idx >= idx + 1:
+                latter_idx += 1
             is_next = 0
-        latter_line = self.lines[latter_idx]
-        return latter_line, torch.as_tensor(is_next)
+        if self.tokenize_in_advance:
+            # "A 'sentence' can be an arbitrary span of contiguous text, rather than an actual
+            # linguistic sentence." Paragraphs are contiguous in `self.flat`, so the second
+            # segment keeps running into the following paragraphs instead of being padded.
+            # When bucketing, it is cut to as many tokens as the first segment so that
+            # the length of the input depends only on the first paragraph.
+            start = self.offsets[latter_idx]
+            latter_len = former_len if self.bucket_by_len else self.seq_len
+            latter_token_ids = self.flat[start: start + latter_len]
+        else:
+            latter_token_ids = self._get_token_ids(latter_idx)
+        return latter_token_ids, is_next
 
     def _to_bert_input(self, former_token_ids, latter_token_ids):
-        token_ids = former_token_ids[: self.seq_len - 2]
-        # Add "[CLS]" and the first "[SEP]" tokens.
-        token_ids = [self.cls_id] + token_ids + [self.sep_id]
-        if len(token_ids) >= self.seq_len:
-            token_ids = token_ids[: self.seq_len]
-        else:
-            if len(token_ids) < self.seq_len - 1:
-                token_ids += latter_token_ids
-                token_ids = token_ids[: self.seq_len - 1]
-                token_ids += [self.sep_id] # Add the second "[SEP]" token.
-            token_ids += [self.pad_id] * (self.seq_len - len(token_ids)) # Pad.
-        return torch.as_tensor(token_ids)
+        # `np.asarray()` turns `np.memmap` slices into plain arrays without copying.
+        return build_bert_sample(
+            np.asarray(former_token_ids),
+            np.asarray(latter_token_ids),
+            self.seq_len,
+            self.cls_id,
+            self.sep_id,
+            self.pad_id,
+        )
+
+    def get_sample_lens(self):
+        # Length of the input built from the `idx`-th paragraph when bucketing; see
+        # `_sample_latter_sentence()`. Only available when tokenized in advance.
+        former_lens = np.minimum(np.diff(self.offsets)[: -1], self.seq_len - 2)
+        return np.minimum(2 * former_lens + 3, self.seq_len)
+
+    def collate_fn(self, batch):
+        # Samples are kept as NumPy arrays up to here so that each field of the batch becomes
+        # a single tensor; `DataLoader(pin_memory=True)` then pins each of them once.
+        token_ids, seg_ids, is_next = (np.stack(field) for field in zip(*batch))
+        if self.bucket_by_len:
+            # Drop the columns that are "[PAD]" for every sample in the batch. (Otherwise
+            # inputs are almost always full and the shape is kept fixed.)
+            batch_len = (token_ids != self.pad_id).sum(axis=1).max()
+            batch_len = min(-(-batch_len // BATCH_LEN_MULTIPLE) * BATCH_LEN_MULTIPLE, self.seq_len)
+            token_ids, seg_ids = token_ids[:, : batch_len], seg_ids[:, : batch_len]
+        return torch.from_numpy(token_ids), torch.from_numpy(seg_ids), torch.from_numpy(is_next)
 
     def __len__(self):
-        return len(self.lines) - 1
+        return self.n_paragraphs - 1
 
     def __getitem__(self, idx):
-        former_line = self.lines[idx]
-        former_token_ids = _encode(former_line, tokenizer=self.tokenizer)
-        latter_line, is_next = self._sample_latter_sentence(idx)
-        latter_token_ids = _encode(latter_line, tokenizer=self.tokenizer)
+        former_token_ids = self._get_token_ids(idx)
+        latter_token_ids, is_next = self._sample_latter_sentence(
+            idx, former_len=len(former_token_ids),
+        )
 
-        token_ids = self._to_bert_input(
+        token_ids, seg_ids = self._to_bert_input(
             former_token_ids=former_token_ids, latter_token_ids=latter_token_ids,
         )
-        seg_ids = _token_ids_to_segment_ids(token_ids=token_ids, sep_id=self.sep_id)
         return token_ids, seg_ids, is_next
+
+
+class BucketBatchSampler(Sampler):
+    # Groups samples of similar lengths into the same batch so that `collate_fn()` can pad
+    # to the longest sample in the batch rather than to `seq_len`. The order of the batches
+    # is shuffled every epoch, and they are sharded across `num_replicas` processes.
+    def __init__(self, lens, batch_size, num_replicas=1, rank=0, shuffle=True, seed=0):
+        self.lens = np.asarray(lens)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        if self.shuffle:
+            # Shuffle first so that samples of the same length are grouped differently
+            # every epoch.
+            indices = rng.permutation(len(self.lens))
+        else:
+            indices = np.arange(len(self.lens))
+        indices = indices[np.argsort(self.lens[indices], kind="stable")]
+
+        n_batches = len(indices) // self.batch_size
+        batches = indices[: n_batches * self.batch_size].reshape(n_batches, self.batch_size)
+        if self.shuffle:
+            batches = batches[rng.permutation(n_batches)]
+        for batch in batches[self.rank: len(self) * self.num_replicas: self.num_replicas]:
+            yield batch.tolist()
+
+    def __len__(self):
+        return (len(self.lens) // self.batch_size) // self.num_replicas
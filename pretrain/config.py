@@ -44,7 +44,9 @@ if N_GPUS > 0:
     DEVICE = torch.device("cuda")
 else:
     DEVICE = torch.device("cpu")
-N_WORKERS = 4
+# DataLoader workers per process; throughput stops improving beyond 8 workers.
+MAX_N_WORKERS = 8
+PREFETCH_FACTOR = 4
 CKPT_DIR = Path(__file__).parent/"checkpoints"
 N_CKPT_SAMPLES = 400_000
 ### Masked Language Model
@@ -1,18 +1,23 @@
 import torch
-import torch.nn as nn
-from torch.utils.data import DataLoader
-from torch.optim import Adam
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, DistributedSampler
+from torch.optim import AdamW
 import gc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from pathlib import Path
 from time import time
 from tqdm.auto import tqdm
 import argparse
+import os
+import sys
 
 import pretrain.config as config
 from utils import get_elapsed_time
 from model import BERTForPretraining
 from pretrain.wordpiece import load_fast_bert_tokenizer
-from pretrain.bookcorpus import BookCorpusForBERT
+from pretrain.bookcorpus import BookCorpusForBERT, BucketBatchSampler
 from pretrain.masked_language_model import MaskedLanguageModel
 
 
@@ -24,58 +29,133 @@ def get_args():
     )
     parser.add_argument("--batch_size", type=int, required=False, default=256)
     parser.add_argument("--tokenize_in_advance", action="store_true")
+    parser.add_argument("--bucket_by_len", action="store_true")
     parser.add_argument("--ckpt_path", type=str, required=False)
 
     args = parser.parse_args()
+    if args.bucket_by_len and not args.tokenize_in_advance:
+        parser.error("--bucket_by_len requires --tokenize_in_advance.")
     return args
 
 
-def save_checkpoint(step, model, optim, ckpt_path):
-    Path(ckpt_path).parent.mkdir(parents=True, exist_ok=True)
+def init_distributed():
+    # Launched with `torchrun --nproc_per_node=<N_GPUS> pretrain/main.py ...`, one process
+    # per GPU; otherwise train in a single process.
+    if "LOCAL_RANK" not in os.environ:
+        return 0, 1
+    dist.init_process_group(backend="nccl")
+    torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def _copy_to_cpu(x):
+    if isinstance(x, torch.Tensor):
+        return x.detach().to("cpu", copy=True)
+    if isinstance(x, dict):
+        return {k: _copy_to_cpu(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(_copy_to_cpu(v) for v in x)
+    return x
+
+
+def get_checkpoint(step, model, optim, scaler):
     ckpt = {
         "step": step,
         "optimizer": optim.state_dict(),
     }
-    if config.N_GPUS > 1:
-        ckpt["model"] = model.module.state_dict()
-    else:
-        ckpt["model"] = model.state_dict()
+    if scaler.is_enabled():
+        ckpt["scaler"] = scaler.state_dict()
+    # `model` should be neither compiled nor wrapped so that the keys of the state dict
+    # carry no "_orig_mod." or "module." prefixes.
+    ckpt["model"] = model.state_dict()
+    # A snapshot on the host, so that training can keep updating the parameters and
+    # the optimizer states in place while the checkpoint is being written.
+    return _copy_to_cpu(ckpt)
+
+
+def save_checkpoint(ckpt, ckpt_path, prev_ckpt_path):
+    Path(ckpt_path).parent.mkdir(parents=True, exist_ok=True)
     torch.save(ckpt, str(ckpt_path))
+    if prev_ckpt_path.exists():
+        prev_ckpt_path.unlink()
 
 
 if __name__ == "__main__":
     # torch.autograd.set_detect_anomaly(True)
 
+    # With "fork" the DataLoader workers share the memory-mapped corpus copy-on-write;
+    # macOS does not fork safely, so fall back to "forkserver" there.
+    torch.multiprocessing.set_start_method(
+        "forkserver" if sys.platform == "darwin" else "fork", force=True,
+    )
+
     gc.collect()
     torch.cuda.empty_cache()
 
     args = get_args()
 
-    print(f"BATCH_SIZE = {args.batch_size}")
-    print(f"N_WORKERS = {config.N_WORKERS}")
-    print(f"MAX_LEN = {config.MAX_LEN}")
-    print(f"SEQ_LEN = {config.SEQ_LEN}")
+    rank, world_size = init_distributed()
+    is_main_process = (rank == 0)
+    # The CPU cores are shared by all the processes on the node.
+    n_workers = max(1, min(os.cpu_count() // world_size, config.MAX_N_WORKERS))
+
+    if is_main_process:
+        print(f"BATCH_SIZE = {args.batch_size}")
+        print(f"N_WORKERS = {n_workers}")
+        print(f"MAX_LEN = {config.MAX_LEN}")
+        print(f"SEQ_LEN = {config.SEQ_LEN}")
+        print(f"WORLD_SIZE = {world_size}")
 
     # "We train with batch size of 256 sequences (256 sequences * 512 tokens
     # = 128,000 tokens/batch) for 1,000,000 steps, which is approximately 40 epochs
     # over the 3.3 billion word corpus." (Comment: 256 * 512 * 1,000,000 / 3,300,000,000
     # = 39.7)
     N_STEPS = (256 * 512 * 1_000_000) // (args.batch_size * config.SEQ_LEN)
-    print(f"N_STEPS = {N_STEPS:,}", end="\n\n")
+    if is_main_process:
+        print(f"N_STEPS = {N_STEPS:,}", end="\n\n")
 
     tokenizer = load_fast_bert_tokenizer(vocab_dir=config.VOCAB_DIR)
+    # Only the main process tokenizes the corpus and writes the cache; the others wait for it
+    # and then load it. Tokenizing takes longer than NCCL's default timeout, so the wait
+    # happens on a separate Gloo group with a long one.
+    wait_for_cache = (world_size > 1 and args.tokenize_in_advance)
+    if wait_for_cache:
+        cache_group = dist.new_group(backend="gloo", timeout=timedelta(hours=12))
+        if not is_main_process:
+            dist.barrier(group=cache_group)
     train_ds = BookCorpusForBERT(
         epubtxt_dir=args.epubtxt_dir,
         tokenizer=tokenizer,
         seq_len=config.SEQ_LEN,
+        tokenize_in_advance=args.tokenize_in_advance,
+        bucket_by_len=args.bucket_by_len,
     )
+    if wait_for_cache and is_main_process:
+        dist.barrier(group=cache_group)
+    # `--batch_size` is the global batch size; it is split evenly across the processes.
+    if args.bucket_by_len:
+        train_sampler = BucketBatchSampler(
+            lens=train_ds.get_sample_lens(),
+            batch_size=args.batch_size // world_size,
+            num_replicas=world_size,
+            rank=rank,
+        )
+        sampler_kwargs = dict(batch_sampler=train_sampler)
+    else:
+        train_sampler = DistributedSampler(
+            train_ds, num_replicas=world_size, rank=rank, shuffle=True, drop_last=True,
+        )
+        sampler_kwargs = dict(
+            batch_size=args.batch_size // world_size, sampler=train_sampler, drop_last=True,
+        )
     train_dl = DataLoader(
         train_ds,
-        batch_size=args.batch_size,
-        shuffle=True,
-        num_workers=config.N_WORKERS,
+        num_workers=n_workers,
         pin_memory=True,
-        drop_last=True,
+        persistent_workers=True,
+        prefetch_factor=config.PREFETCH_FACTOR,
+        collate_fn=train_ds.collate_fn,
+        **sampler_kwargs,
     )
 
     model = BERTForPretraining( # Smaller than BERT-Base
@@ -87,12 +167,19 @@ if __name__ == "__main__":
         hidden_size=config.HIDDEN_SIZE,
         mlp_size=config.MLP_SIZE,
     ).to(config.DEVICE)
-    if config.N_GPUS > 1:
-        model = nn.DataParallel(model)
+    unwrapped_model = model
+    if config.DEVICE.type == "cuda":
+        # Without bucketing `SEQ_LEN` is fixed, so the graph is compiled once
+        # with static shapes.
+        model = torch.compile(
+            model, mode="max-autotune", fullgraph=False, dynamic=args.bucket_by_len,
+        )
+    if world_size > 1:
+        model = DDP(model, device_ids=[torch.cuda.current_device()])
 
     mlm = MaskedLanguageModel(
         vocab_size=config.VOCAB_SIZE,
-        mask_id=tokenizer.mask_token_id,
+        mask_id=train_ds.mask_id,
         no_mask_token_ids=[
             train_ds.unk_id, train_ds.cls_id, train_ds.sep_id, train_ds.pad_id, train_ds.unk_id,
         ],
@@ -101,85 +188,150 @@ if __name__ == "__main__":
         randomize_prob=config.RANDOMIZE_PROB,
     )
 
-    optim = Adam(
+    # Decoupled weight decay; the fused implementation updates all the parameters
+    # in a single kernel launch.
+    optim = AdamW(
         model.parameters(),
         lr=config.MAX_LR,
         betas=(config.BETA1, config.BETA2),
         weight_decay=config.WEIGHT_DECAY,
+        fused=torch.cuda.is_available(),
     )
 
+    # "bfloat16" has the same dynamic range as "float32", so loss scaling is only needed
+    # when falling back to "float16" on GPUs older than Ampere.
+    device_type = config.DEVICE.type
+    use_amp = (device_type == "cuda")
+    if use_amp and torch.cuda.is_bf16_supported():
+        amp_dtype = torch.bfloat16
+    else:
+        amp_dtype = torch.float16
+    scaler = torch.amp.GradScaler("cuda", enabled=use_amp and amp_dtype == torch.float16)
+
     ### Resume
     if args.ckpt_path is not None:
         ckpt = torch.load(args.ckpt_path, map_location=config.DEVICE)
-        if config.N_GPUS > 1:
-            model.module.load_state_dict(ckpt["model"])
-        else:
-            model.load_state_dict(ckpt["model"])
+        unwrapped_model.load_state_dict(ckpt["model"])
         optim.load_state_dict(ckpt["optimizer"])
+        if scaler.is_enabled() and "scaler" in ckpt:
+            scaler.load_state_dict(ckpt["scaler"])
         step = ckpt["step"]
         prev_ckpt_path = Path(args.ckpt_path)
-        print(f"Resuming from checkpoint\n    '{str(Path(args.ckpt_path).name)}'...")
+        if is_main_process:
+            print(f"Resuming from checkpoint\n    '{str(Path(args.ckpt_path).name)}'...")
     else:
         step = 0
         prev_ckpt_path = Path(".pth")
 
-    print("Training...")
+    if is_main_process:
+        print("Training...")
     start_time = time()
-    accum_nsp_loss = 0
-    accum_nsp_acc = 0
-    accum_mlm_loss = 0
-    accum_mlm_acc = 0
+    # Accumulated on the device so that the host waits for the GPU only when logging.
+    accum_nsp_loss = torch.zeros((), device=config.DEVICE)
+    accum_nsp_acc = torch.zeros((), device=config.DEVICE)
+    accum_mlm_loss = torch.zeros((), device=config.DEVICE)
+    accum_mlm_n_corrects = torch.zeros((), dtype=torch.long, device=config.DEVICE)
+    accum_mlm_n_selected = torch.zeros((), dtype=torch.long, device=config.DEVICE)
     step_cnt = 0
+    epoch = 0
+    n_ckpt_steps = max(1, config.N_CKPT_SAMPLES // args.batch_size)
+    # Checkpoints are written by a background thread, one at a time.
+    ckpt_executor = ThreadPoolExecutor(max_workers=1)
+    save_future = None
     while True:
+        train_sampler.set_epoch(epoch)
+        epoch += 1
         for gt_token_ids, seg_ids, gt_is_next in train_dl:
             if step < N_STEPS:
                 step +=1
 
-                gt_token_ids = gt_token_ids.to(config.DEVICE)
-                seg_ids = seg_ids.to(config.DEVICE)
-                gt_is_next = gt_is_next.to(config.DEVICE)
+                # Token IDs are stored as `int32` on the host to halve the transfer.
+                gt_token_ids = gt_token_ids.to(config.DEVICE, non_blocking=True).long()
+                seg_ids = seg_ids.to(config.DEVICE, non_blocking=True).long()
+                gt_is_next = gt_is_next.to(config.DEVICE, non_blocking=True)
 
                 masked_token_ids, select_mask = mlm(gt_token_ids)
 
-                pred_is_next, pred_token_ids = model(token_ids=masked_token_ids, seg_ids=seg_ids)
-                nsp_loss, mlm_loss = model.get_pretraining_loss(
-                    pred_is_next=pred_is_next,
-                    gt_is_next=gt_is_next,
-                    pred_token_ids=pred_token_ids,
-                    gt_token_ids=gt_token_ids,
-                    select_mask=select_mask,
-                )
-                loss = nsp_loss + mlm_loss
-
-                optim.zero_grad()
-                loss.backward()
-                optim.step()
-
-                accum_nsp_loss += nsp_loss.item()
-                accum_mlm_loss += mlm_loss.item()
-
-                nsp_acc = model.get_nsp_acc(pred_is_next=pred_is_next, gt_is_next=gt_is_next)
-                mlm_acc = model.get_mlm_acc(pred_token_ids=pred_token_ids, gt_token_ids=gt_token_ids)
-                accum_nsp_acc += nsp_acc
-                accum_mlm_acc += mlm_acc
+                with torch.autocast(
+                    device_type=device_type, dtype=amp_dtype, enabled=use_amp,
+                ):
+                    pred_is_next, pred_token_ids = model(
+                        token_ids=masked_token_ids, seg_ids=seg_ids,
+                    )
+                    nsp_loss, mlm_loss = unwrapped_model.get_pretraining_loss(
+                        pred_is_next=pred_is_next,
+                        gt_is_next=gt_is_next,
+                        pred_token_ids=pred_token_ids,
+                        gt_token_ids=gt_token_ids,
+                        select_mask=select_mask,
+                    )
+                    loss = nsp_loss + mlm_loss
+
+                optim.zero_grad(set_to_none=True)
+                if scaler.is_enabled():
+                    scaler.scale(loss).backward()
+                    scaler.step(optim)
+                    scaler.update()
+                else:
+                    loss.backward()
+                    optim.step()
+
+                with torch.no_grad():
+                    accum_nsp_loss += nsp_loss.detach()
+                    accum_mlm_loss += mlm_loss.detach()
+
+                    nsp_acc = unwrapped_model.get_nsp_acc(
+                        pred_is_next=pred_is_next, gt_is_next=gt_is_next,
+                    )
+                    mlm_n_corrects, mlm_n_selected = unwrapped_model.get_mlm_n_corrects(
+                        pred_token_ids=pred_token_ids,
+                        gt_token_ids=gt_token_ids,
+                        select_mask=select_mask,
+                    )
+                    accum_nsp_acc += nsp_acc
+                    accum_mlm_n_corrects += mlm_n_corrects
+                    accum_mlm_n_selected += mlm_n_selected
                 step_cnt += 1
 
-                if (step % (config.N_CKPT_SAMPLES // args.batch_size) == 0) or (step == N_STEPS):
-                    print(f"[ {step:,}/{N_STEPS:,} ][ {get_elapsed_time(start_time)} ]", end="")
-                    print(f"[ NSP loss: {accum_nsp_loss / step_cnt:.4f} ]", end="")
-                    print(f"[ NSP acc: {accum_nsp_acc / step_cnt:.3f} ]", end="")
-                    print(f"[ MLM loss: {accum_mlm_loss / step_cnt:.4f} ]", end="")
-                    print(f"[ MLM acc: {accum_mlm_acc / step_cnt:.3f} ]")
+                if (step % n_ckpt_steps == 0) or (step == N_STEPS):
+                    if is_main_process:
+                        print(f"[ {step:,}/{N_STEPS:,} ][ {get_elapsed_time(start_time)} ]", end="")
+                        print(f"[ NSP loss: {accum_nsp_loss.item() / step_cnt:.4f} ]", end="")
+                        print(f"[ NSP acc: {accum_nsp_acc.item() / step_cnt:.3f} ]", end="")
+                        print(f"[ MLM loss: {accum_mlm_loss.item() / step_cnt:.4f} ]", end="")
+                        mlm_acc = accum_mlm_n_corrects.item() / max(1, accum_mlm_n_selected.item())
+                        print(f"[ MLM acc: {mlm_acc:.3f} ]")
 
                     start_time = time()
-                    accum_nsp_loss = 0
-                    accum_nsp_acc = 0
-                    accum_mlm_loss = 0
-                    accum_mlm_acc = 0
+                    accum_nsp_loss.zero_()
+                    accum_nsp_acc.zero_()
+                    accum_mlm_loss.zero_()
+                    accum_mlm_n_corrects.zero_()
+                    accum_mlm_n_selected.zero_()
                     step_cnt = 0
 
-                    cur_ckpt_path = config.CKPT_DIR/f"bookcorpus_step_{step}.pth"
-                    save_checkpoint(step=step, model=model, optim=optim, ckpt_path=cur_ckpt_path)
-                    if prev_ckpt_path.exists():
-                        prev_ckpt_path.unlink()
-                    prev_ckpt_path = cur_ckpt_path
+                    if is_main_process:
+                        cur_ckpt_path = config.CKPT_DIR/f"bookcorpus_step_{step}.pth"
+                        ckpt = get_checkpoint(
+                            step=step, model=unwrapped_model, optim=optim, scaler=scaler,
+                        )
+                        if save_future is not None:
+                            # Also re-raises any error from the previous save.
+                            save_future.result()
+                        save_future = ckpt_executor.submit(
+                            save_checkpoint,
+                            ckpt=ckpt,
+                            ckpt_path=cur_ckpt_path,
+                            prev_ckpt_path=prev_ckpt_path,
+                        )
+                        prev_ckpt_path = cur_ckpt_path
+            else:
+                break
+        if step >= N_STEPS:
+            break
+
+    if save_future is not None:
+        save_future.result()
+    ckpt_executor.shutdown()
+    if world_size > 1:
+        dist.destroy_process_group()
@@ -19,49 +19,45 @@ class MaskedLanguageModel(object):
     ):
         self.vocab_size = vocab_size
         self.mask_id = mask_id
-        self.no_mask_token_ids = no_mask_token_ids
+        self.no_mask_token_ids = list(no_mask_token_ids)
         self.select_prob = select_prob
         self.mask_prob = mask_prob
         self.randomize_prob = randomize_prob
 
-        if mask_id not in no_mask_token_ids:
-            no_mask_token_ids += [mask_id]
-
+        if mask_id not in self.no_mask_token_ids:
+            self.no_mask_token_ids += [mask_id]
+        self._no_mask_token_ids = torch.as_tensor(self.no_mask_token_ids)
 
     def __call__(self, gt_token_ids):
-        masked_token_ids = gt_token_ids.clone()
+        # All the masks are built on `gt_token_ids.device` from a single uniform draw
+        # and no host synchronization takes place.
+        if self._no_mask_token_ids.device != gt_token_ids.device:
+            self._no_mask_token_ids = self._no_mask_token_ids.to(gt_token_ids.device)
 
-        rand_tensor = torch.rand(masked_token_ids.shape, device=masked_token_ids.device)
-        no_mask_mask = torch.isin(
-            masked_token_ids,
-            torch.as_tensor(self.no_mask_token_ids, device=masked_token_ids.device),
-        )
+        rand_tensor = torch.rand(gt_token_ids.shape, device=gt_token_ids.device)
+        no_mask_mask = torch.isin(gt_token_ids, self._no_mask_token_ids)
         rand_tensor.masked_fill_(mask=no_mask_mask, value=1)
 
         # "Chooses 15% of the token positions at random for prediction."
         select_mask = (rand_tensor < self.select_prob)
         # `select_mask.sum() / gt_token_ids.numel() ~= 0.15`
 
+        # Given that the $i$-th token is chosen, `rand_tensor / self.select_prob` is uniform
+        # over $[0, 1)$, so it can be split further without drawing again.
         # "If the $i$-th token is chosen, we replace the $i$-th token with (1) the [MASK] token
         # 80% of the time."
-        rand_tensor = torch.rand(masked_token_ids.shape, device=masked_token_ids.device)
-        mask_mask = select_mask & (rand_tensor < self.mask_prob)
+        mask_thresh = self.select_prob * self.mask_prob
+        mask_mask = (rand_tensor < mask_thresh)
         # `mask_mask.sum() / select_mask.sum() ~= 0.8`
-        masked_token_ids.masked_fill_(mask=mask_mask, value=self.mask_id)
+        masked_token_ids = gt_token_ids.masked_fill(mask=mask_mask, value=self.mask_id)
 
         # "(2) a random token 10% of the time
         # (3) the unchanged $i$-th token 10% of the time."
-        rand_tensor = torch.rand(masked_token_ids.shape, device=masked_token_ids.device)
-        randomize_mask = select_mask &\
-            (rand_tensor >= self.mask_prob) &\
-            (rand_tensor < (self.mask_prob + self.randomize_prob))
+        randomize_mask = (rand_tensor >= mask_thresh) &\
+            (rand_tensor < self.select_prob * (self.mask_prob + self.randomize_prob))
         # `randomize_mask.sum() / select_mask.sum() ~= 0.1`
-        random_token_ids = torch.randint(
-            high=self.vocab_size,
-            size=torch.Size((randomize_mask.sum(),)),
-            device=masked_token_ids.device,
-        )
-        masked_token_ids[randomize_mask.nonzero(as_tuple=True)] = random_token_ids
+        random_token_ids = torch.randint_like(gt_token_ids, high=self.vocab_size)
+        masked_token_ids = torch.where(randomize_mask, random_token_ids, masked_token_ids)
         return masked_token_ids, select_mask
 
 
@@ -9,6 +9,7 @@ from tokenizers.pre_tokenizers import Whitespace
 from tokenizers.trainers import WordPieceTrainer
 from tokenizers import decoders
 from pathlib import Path
+from collections import namedtuple
 from tqdm.auto import tqdm
 import re
 import argparse
@@ -31,16 +32,18 @@ def get_args():
 def parse(epubtxt_dir, with_document=False):
     print("Parsing BookCorpus...")
     lines = list()
-    for doc_path in tqdm(list(Path(epubtxt_dir).glob("*.txt"))):
-        with open(doc_path, mode="r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if (not line) or (re.search(pattern=REGEX, string=line)) or (line.count(" ") < 1):
-                    continue
-                if not with_document:
-                    lines.append(line)
-                else:
-                    lines.append((doc_path.name, line))
+    # Sorted so that the paragraph indices (and the tokenized corpus cached from them)
+    # do not depend on the order the file system lists the files in.
+    for doc_path in tqdm(sorted(Path(epubtxt_dir).glob("*.txt"))):
+        # Read each document at once rather than line by line.
+        for line in doc_path.read_text(encoding="utf-8").split("\n"):
+            line = line.strip()
+            if (not line) or (re.search(pattern=REGEX, string=line)) or (line.count(" ") < 1):
+                continue
+            if not with_document:
+                lines.append(line)
+            else:
+                lines.append((doc_path.name, line))
     print("Completed.")
     print(f"Number of paragraphs: {len(lines):,}")
     return lines
@@ -78,6 +81,21 @@ def load_fast_bert_tokenizer(vocab_dir):
     return tokenizer
 
 
+SpecialIds = namedtuple("SpecialIds", "cls sep pad unk mask")
+
+
+def get_special_ids(tokenizer):
+    # Each `<...>_token_id` attribute of `BertTokenizerFast` is a vocabulary lookup,
+    # so resolve them once into plain `int`s.
+    return SpecialIds(
+        cls=int(tokenizer.cls_token_id),
+        sep=int(tokenizer.sep_token_id),
+        pad=int(tokenizer.pad_token_id),
+        unk=int(tokenizer.unk_token_id),
+        mask=int(tokenizer.mask_token_id),
+    )
+
+
 if __name__ == "__main__":
     args = get_args()
 